@@ -1,5 +1,4 @@
-import os, re, csv, io
-import tempfile
+import re, csv, io
 from typing import List, Dict, Tuple, Optional
 import streamlit as st
 
@@ -23,6 +22,7 @@ MARGIN = 1.0 * cm
 GAP = 0.35 * cm              # espace entre cartes (découpe)
 BORDER_WIDTH = 1
 ELEMENT_SPACING = 0.8 * cm   # Espace entre les éléments (texte, image) et les bords de la carte
+EMPTY_CARD = {"question": "", "texte": "", "card_color_key": None}  # carte vide de remplissage (lecture seule)
 
 # Couleurs (verso) selon le nom du fichier
 COLOR_MAP = {
@@ -33,28 +33,51 @@ COLOR_MAP = {
     "jaune": colors.HexColor("#F1C40F"),
 }
 
+# Regex précompilées (appelées pour chaque ligne du CSV)
+_COLOR_SUFFIX_RE = re.compile(r'\s*\(([^)]+)\)\s*$', re.IGNORECASE)
+_WS_RE = re.compile(r"\s+")
+_COLOR_NAME_RE = re.compile("(" + "|".join(COLOR_MAP) + ")", re.IGNORECASE)
+
 def pick_color_from_filename(filename: str) -> Tuple[str, colors.Color]:
-    low = filename.lower()
-    for key in ["bleu", "rouge", "rose", "vert", "jaune"]:
-        if key in low:
-            return key, COLOR_MAP[key]
-    return "bleu", COLOR_MAP["bleu"]
+    m = _COLOR_NAME_RE.search(filename)
+    key = m.group(1).lower() if m else "bleu"
+    return key, COLOR_MAP[key]
 
 def is_dark(c: colors.Color) -> bool:
     r, g, b = c.red, c.green, c.blue
     lum = 0.2126*r + 0.7152*g + 0.0722*b
     return lum < 0.55
 
+CSV_DELIMITERS = ",;|\t"
+
 def sniff_dialect(data: str) -> csv.Dialect:
+    # Chemin rapide : un seul séparateur présent sur la 1re ligne, inutile de lancer le Sniffer
+    lines = data[:2048].splitlines()
+    first_line = lines[0] if lines else ""
+    found = [d for d in CSV_DELIMITERS if d in first_line]
+    if len(found) == 1:
+        class _Dialect(csv.excel):
+            delimiter = found[0]
+        return _Dialect
+
     sniffer = csv.Sniffer()
     try:
-        dialect = sniffer.sniff(data[:4096], delimiters=";,|, ,\t,")
+        dialect = sniffer.sniff(data[:4096], delimiters=CSV_DELIMITERS)
     except Exception:
         dialect = csv.get_dialect("excel")
     return dialect
 
 def normalize_header(h: str) -> str:
-    return re.sub(r"\s+", "", (h or "").strip().lower())
+    return _WS_RE.sub("", h.strip().lower() if h else "")
+
+def split_color_suffix(q_raw: str) -> Tuple[str, Optional[str]]:
+    # "(couleur)" en fin de question : une seule recherche, puis découpe à m.start()
+    m = _COLOR_SUFFIX_RE.search(q_raw)
+    if m:
+        key = m.group(1).lower().strip()
+        if key in COLOR_MAP:
+            return q_raw[:m.start()].rstrip(), key
+    return q_raw, None
 
 def read_cards_from_csv(csv_file_content: str) -> List[Dict[str, str]]:
     """
@@ -65,7 +88,7 @@ def read_cards_from_csv(csv_file_content: str) -> List[Dict[str, str]]:
     # Use io.StringIO to treat the string content as a file
     f = io.StringIO(csv_file_content)
 
-    dialect = sniff_dialect(csv_file_content)
+    dialect = sniff_dialect(csv_file_content[:4096])
     reader = csv.reader(f, dialect)
     rows = list(reader)
     if not rows:
@@ -75,50 +98,35 @@ def read_cards_from_csv(csv_file_content: str) -> List[Dict[str, str]]:
     norm_first = [normalize_header(x) for x in first]
     has_header = any(x in ("question","q","texte","text","reponse","réponse","answer","reponseverso","verso") for x in norm_first)
 
-    def get_field(d: Dict[str,str], keys: List[str], fallback: str="") -> str:
+    # En-tête en double : la dernière colonne l'emporte
+    col_of = {h: i for i, h in enumerate(norm_first)}
+
+    def find_col(keys: Tuple[str, ...]) -> Optional[int]:
         for k in keys:
-            nk = normalize_header(k)
-            for kk, vv in d.items():
-                if normalize_header(kk) == nk:
-                    return (vv or "").strip()
-        return fallback
+            if k in col_of:
+                return col_of[k]
+        return None
 
     out = []
     if has_header:
-        headers = norm_first
+        # Colonnes résolues une seule fois (les en-têtes sont les mêmes pour toutes les lignes)
+        q_idx = find_col(("question","q"))
+        t_idx = find_col(("texte","text","reponse","réponse","answer","verso","reponseverso"))
         for r in rows[1:]:
-            if not any(str(x).strip() for x in r):
+            if not any(cell and not cell.isspace() for cell in r):
                 continue
-            d = {headers[i]: (r[i].strip() if i < len(r) else "") for i in range(len(headers))}
-            q_raw = get_field(d, ["question","q"])
-            card_color_key = None
-            question_text = q_raw # Default to raw question
-
-            # Regex to find (color) at the end of the string, case-insensitive
-            match = re.search(r'\(([^)]+)\)\s*$', q_raw, re.IGNORECASE)
-            if match:
-                extracted_color_name = match.group(1).lower().strip()
-                if extracted_color_name in COLOR_MAP:
-                    card_color_key = extracted_color_name
-                    question_text = re.sub(r'\s*\(([^)]+)\)\s*$', '', q_raw, flags=re.IGNORECASE).strip()
-
-            txt = get_field(d, ["texte","text","reponse","réponse","answer","verso","reponseverso"])
+            q_raw = r[q_idx].strip() if q_idx is not None and q_idx < len(r) else ""
+            question_text, card_color_key = split_color_suffix(q_raw)
+
+            txt = r[t_idx].strip() if t_idx is not None and t_idx < len(r) else ""
             out.append({"question": question_text, "texte": txt, "card_color_key": card_color_key})
     else:
         # Sans en-tête : col1=question, col2=texte (si col2 vide, on tente col3)
         for r in rows:
-            if not any(str(x).strip() for x in r):
+            if not any(cell and not cell.isspace() for cell in r):
                 continue
             q_raw = (r[0].strip() if len(r) > 0 else "")
-            card_color_key = None
-            question_text = q_raw
-
-            match = re.search(r'\(([^)]+)\)\s*$', q_raw, re.IGNORECASE)
-            if match:
-                extracted_color_name = match.group(1).lower().strip()
-                if extracted_color_name in COLOR_MAP:
-                    card_color_key = extracted_color_name
-                    question_text = re.sub(r'\s*\(([^)]+)\)\s*$', '', q_raw, flags=re.IGNORECASE).strip()
+            question_text, card_color_key = split_color_suffix(q_raw)
 
             txt = (r[1].strip() if len(r) > 1 else "")
             if not txt and len(r) > 2:
@@ -160,6 +168,9 @@ def draw_card_border(c: canvas.Canvas, x: float, y: float, w: float, h: float, s
     c.rect(x, y, w, h, stroke=1, fill=0)
 
 def draw_centered_text_in_box(c: canvas.Canvas, x: float, y: float, w: float, h: float, text: str, style: ParagraphStyle):
+    if not (text and text.strip()):
+        return
+
     pad = 6 # Internal padding for the text within the card
 
     # Calculate the inner dimensions for the text area
@@ -168,11 +179,23 @@ def draw_centered_text_in_box(c: canvas.Canvas, x: float, y: float, w: float, h:
     inner_w = w - 2 * pad
     inner_h = h - 2 * pad
 
-    p = Paragraph((text or "").replace("\n","<br/>") if (text or "").strip() else "&nbsp;", style)
+    # Chemin rapide : texte court sur une ligne, sans balisage -> drawCentredString au lieu d'un Paragraph
+    if "\n" not in text and "<" not in text and "&" not in text:
+        line = " ".join(text.split())
+        if c.stringWidth(line, style.fontName, style.fontSize) <= inner_w:
+            # Même ligne de base que le Paragraph d'une ligne (hauteur = leading) centré verticalement
+            baseline_y = inner_y + inner_h / 2 + style.leading / 2 - style.fontSize
+            c.saveState()
+            c.setFont(style.fontName, style.fontSize)
+            c.setFillColor(style.textColor)
+            c.drawCentredString(inner_x + inner_w / 2, baseline_y, line)
+            c.restoreState()
+            return
+
+    p = Paragraph(text.replace("\n","<br/>"), style)
 
     # Get the actual height the paragraph would take if wrapped within inner_w
-    # We pass a temporary canvas and a very large height to allow it to compute its natural height
-    text_width, text_height = p.wrapOn(c, inner_w, inner_h * 100)
+    text_width, text_height = p.wrapOn(c, inner_w, inner_h)
 
     # Ensure text_height does not exceed inner_h, and shrink if necessary
     if text_height > inner_h:
@@ -188,131 +211,156 @@ def draw_centered_text_in_box(c: canvas.Canvas, x: float, y: float, w: float, h:
 
 def build_pdf(cards: List[Dict[str,str]], default_back_color: colors.Color, output_buffer: io.BytesIO, uploaded_image_file: Optional[io.BytesIO] = None):
     grid = compute_grid()
+    card_w, card_h = grid.card_w, grid.card_h
+    # Positions des cartes calculées une fois (verso : colonnes inversées)
+    recto_xy = [card_xy(grid, i % COLS, i // COLS) for i in range(NB_CARTES)]
+    verso_xy = [card_xy(grid, COLS - 1 - (i % COLS), i // COLS) for i in range(NB_CARTES)]
 
     base_font = "Helvetica"
     style_verso = ParagraphStyle(
         "Verso", fontName=base_font, fontSize=12.5, leading=14.5,
         alignment=TA_CENTER, textColor=colors.black
     )
+    # Styles recto (texte blanc sur fond foncé, noir sinon), créés une fois pour toutes les cartes
+    style_recto_dark = ParagraphStyle(
+        "RectoDark", fontName=base_font, fontSize=16, leading=18,
+        alignment=TA_CENTER, textColor=colors.white
+    )
+    style_recto_light = ParagraphStyle(
+        "RectoLight", fontName=base_font, fontSize=16, leading=18,
+        alignment=TA_CENTER, textColor=colors.black
+    )
+    dark_cache = {k: is_dark(v) for k, v in COLOR_MAP.items()}
+    default_is_dark = is_dark(default_back_color)
 
-    cards10 = (cards[:NB_CARTES] + [{"question":"","texte":""}] * NB_CARTES)[:NB_CARTES]
+    cards10 = cards[:NB_CARTES]
+    pad = NB_CARTES - len(cards10)
+    if pad:
+        cards10 = cards10 + [EMPTY_CARD] * pad
 
-    c = canvas.Canvas(output_buffer, pagesize=A4)
+    c = canvas.Canvas(output_buffer, pagesize=A4, pageCompression=1)
 
     original_pil_image = None
-    temp_image_files_to_clean = []
+    opaque_image = None
+    fully_opaque = False
 
     if uploaded_image_file:
         try:
             original_pil_image = Image.open(uploaded_image_file)
-            if original_pil_image.mode != 'RGBA':
-                original_pil_image = original_pil_image.convert('RGBA')
+            # Décodage immédiat : une image corrompue échoue ici une seule fois, pas à chaque drawImage
+            original_pil_image.load()
+            # Sans transparence (JPEG...) ou alpha partout à 255, l'image est la même sur tous les fonds
+            fully_opaque = original_pil_image.mode in ('RGB', 'L', 'P') and 'transparency' not in original_pil_image.info
+            if not fully_opaque:
+                if original_pil_image.mode != 'RGBA':
+                    original_pil_image = original_pil_image.convert('RGBA')
+                fully_opaque = original_pil_image.getchannel('A').getextrema()[0] == 255
+            if fully_opaque and original_pil_image.mode != 'RGB':
+                original_pil_image = original_pil_image.convert('RGB')
         except Exception as e:
             st.error(f"Erreur lors du prétraitement de l'image : {e}")
             original_pil_image = None
 
+    composited = {}
+    if original_pil_image:
+        if fully_opaque:
+            # Pas de compositing : une seule image pour toutes les cartes
+            opaque_image = ImageReader(original_pil_image)
+        else:
+            # Une seule image composée par couleur de fond utilisée (et non une par carte)
+            for card in cards10:
+                card_specific_color_key = card.get("card_color_key")
+                if card_specific_color_key in composited:
+                    continue
+                current_back_color = COLOR_MAP.get(card_specific_color_key, default_back_color)
+                try:
+                    r = current_back_color.red
+                    g = current_back_color.green
+                    b = current_back_color.blue
+                    bg_color_tuple = (int(r * 255), int(g * 255), int(b * 255))
+
+                    alpha_composite_img = Image.new('RGB', original_pil_image.size, bg_color_tuple)
+                    alpha_composite_img.paste(original_pil_image, (0, 0), original_pil_image)
+
+                    buf = io.BytesIO()
+                    # Compression minimale : le PDF recompresse de toute façon l'image
+                    alpha_composite_img.save(buf, format='PNG', optimize=False, compress_level=1)
+                    buf.seek(0)
+                    composited[card_specific_color_key] = ImageReader(buf)
+
+                except Exception as e:
+                    st.error(f"Erreur lors du compositing de l'image pour la couleur {card_specific_color_key or 'par défaut'}: {e}")
+                    composited[card_specific_color_key] = None
+
     # -------- Recto --------
     for i in range(NB_CARTES):
-        row = i // COLS
-        col = i % COLS
-        x, y = card_xy(grid, col, row)
+        x, y = recto_xy[i]
 
         card_specific_color_key = cards10[i].get("card_color_key")
         current_back_color = COLOR_MAP.get(card_specific_color_key, default_back_color)
 
-        style_recto = ParagraphStyle(
-            "Recto", fontName=base_font, fontSize=16, leading=18,
-            alignment=TA_CENTER, textColor=(colors.white if is_dark(current_back_color) else colors.black)
-        )
+        style_recto = style_recto_dark if dark_cache.get(card_specific_color_key, default_is_dark) else style_recto_light
 
         c.setFillColor(current_back_color)
-        c.rect(x, y, grid.card_w, grid.card_h, stroke=0, fill=1)
+        c.rect(x, y, card_w, card_h, stroke=0, fill=1)
 
         question_text_for_card = cards10[i].get("question", "").strip()
 
-        image_to_draw_path = None
-        if original_pil_image:
-            try:
-                r = current_back_color.red
-                g = current_back_color.green
-                b = current_back_color.blue
-                bg_color_tuple = (int(r * 255), int(g * 255), int(b * 255))
+        image_to_draw = opaque_image or composited.get(card_specific_color_key)
 
-                alpha_composite_img = Image.new('RGB', original_pil_image.size, bg_color_tuple)
-                alpha_composite_img.paste(original_pil_image, (0, 0), original_pil_image)
-
-                with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_png_file:
-                    image_to_draw_path = temp_png_file.name
-                    alpha_composite_img.save(temp_png_file, format='PNG')
-                temp_image_files_to_clean.append(image_to_draw_path)
-
-            except Exception as e:
-                st.error(f"Erreur lors du compositing de l'image pour la carte {i}: {e}")
-                image_to_draw_path = None
-
-
-        if image_to_draw_path:
+        if image_to_draw:
             if not question_text_for_card:
                 # No text, image takes up 90% of card height, centered
-                img_h = 0.9 * grid.card_h
+                img_h = 0.9 * card_h
                 img_w = img_h # Maintain 1:1 aspect ratio
-                img_x = x + (grid.card_w - img_w) / 2 # Center horizontally
-                img_y = y + (grid.card_h - img_h) / 2 # Center vertically
+                img_x = x + (card_w - img_w) / 2 # Center horizontally
+                img_y = y + (card_h - img_h) / 2 # Center vertically
                 
                 try:
-                    c.drawImage(image_to_draw_path, img_x, img_y,
+                    c.drawImage(image_to_draw, img_x, img_y,
                                 width=img_w, height=img_h, preserveAspectRatio=True)
                 except Exception as e:
                     st.error(f"Erreur lors du dessin de l'image (90% hauteur, sans texte) : {e}")
                     # If image drawing fails, draw empty text centrally as a fallback
-                    draw_centered_text_in_box(c, x, y, grid.card_w, grid.card_h, "", style_recto)
+                    draw_centered_text_in_box(c, x, y, card_w, card_h, "", style_recto)
             else:
                 # Text is present, use original image/text layout
-                img_h = grid.card_h / 2
+                img_h = card_h / 2
                 img_w = img_h
 
-                img_x = x + (grid.card_w - img_w) / 2
+                img_x = x + (card_w - img_w) / 2
                 img_y = y + ELEMENT_SPACING
 
-                text_box_h = grid.card_h - (3 * ELEMENT_SPACING + img_h)
+                text_box_h = card_h - (3 * ELEMENT_SPACING + img_h)
 
                 text_box_x = x
                 text_box_y = img_y + img_h + ELEMENT_SPACING
-                text_box_w = grid.card_w
+                text_box_w = card_w
 
                 try:
-                    c.drawImage(image_to_draw_path, img_x, img_y,
+                    c.drawImage(image_to_draw, img_x, img_y,
                                 width=img_w, height=img_h, preserveAspectRatio=True)
                 except Exception as e:
                     st.error(f"Erreur lors du dessin de l'image (avec texte) : {e}")
                     # Fallback: draw text in full card area if image drawing still fails
-                    draw_centered_text_in_box(c, x, y, grid.card_w, grid.card_h, question_text_for_card, style_recto)
+                    draw_centered_text_in_box(c, x, y, card_w, card_h, question_text_for_card, style_recto)
                     continue
 
                 draw_centered_text_in_box(c, text_box_x, text_box_y, text_box_w, text_box_h, question_text_for_card, style_recto)
         else:
             # No image or image processing failed, draw text in the full card area
-            draw_centered_text_in_box(c, x, y, grid.card_w, grid.card_h, question_text_for_card, style_recto)
+            draw_centered_text_in_box(c, x, y, card_w, card_h, question_text_for_card, style_recto)
 
     c.showPage()
 
     # -------- Verso (colonnes inversées) --------
     for i in range(NB_CARTES):
-        row = i // COLS
-        col = i % COLS
-        back_col = (COLS - 1 - col)
-        x, y = card_xy(grid, back_col, row)
+        x, y = verso_xy[i]
 
-        draw_centered_text_in_box(c, x, y, grid.card_w, grid.card_h, cards10[i].get("texte", ""), style_verso)
+        draw_centered_text_in_box(c, x, y, card_w, card_h, cards10[i].get("texte", ""), style_verso)
 
     c.save()
 
-    for temp_file in temp_image_files_to_clean:
-        try:
-            os.remove(temp_file)
-        except OSError as e:
-            st.warning(f"Erreur lors de la suppression du fichier temporaire {temp_file}: {e}")
-
 
 # ----------------------------
 # Streamlit Application Logic
@@ -334,7 +382,8 @@ if uploaded_csv_file is None:
     st.warning("Veuillez uploader un fichier CSV pour commencer.")
 else:
     # Read CSV content from the uploaded file
-    csv_content = uploaded_csv_file.getvalue().decode("utf-8")
+    # errors="replace" : les exports Excel en cp1252 ne font plus planter la lecture
+    csv_content = uploaded_csv_file.getvalue().decode("utf-8-sig", errors="replace")
     csv_name = uploaded_csv_file.name
 
     color_name, default_back_color = pick_color_from_filename(csv_name)